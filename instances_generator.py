@@ -19,10 +19,11 @@
 '''
 
 import os
-import random
 import argparse
 import numpy as np
 import math
+from multiprocessing import Pool
+from numba import njit
 
 __author__ = "Marcelo Bianchetti"
 __credits__ = ["Marcelo Bianchetti", "Ignacio Mariotti"]
@@ -31,8 +32,24 @@ __maintainer__ = "Ignacio Mariotti"
 __email__ = "mariotti.ignacio at dc.uba.ar"
 __status__ = "Production"
 
-line_enter = '{}\n'
 sep = '\t'
+instance_fname = 'instance_{}_{}_{}_{}_{}.txt'
+
+# Header shared by every instance file, only the seed is filled per file
+_PROLOG = ('# Created by {}\n'
+           '# Version: {}\n'
+           '# Seed: %d\n'
+           '# Format:\n'
+           '#   First line: S  |D|\n'
+           '#   Other lines: <src #dst dst_1 dst_2 ... dst_#dst #slots>\n'
+           .format(__author__, __version__).encode())
+
+# Layout of a demand with a single destination: <src 1 dst #slots>
+_SINGLE_DST_ROW = '%d{0}1{0}%d{0}%d\n'.format(sep).encode()
+
+# Default amounts of available slots per fiber
+DEFAULT_S = (10, 15, 20, 30, 40, 60, 80, 100, 150, 200, 300, 400, 600, 800,
+             1000)
 
 
 def error(err):
@@ -40,17 +57,92 @@ def error(err):
     exit(1)
 
 
-def getPair(n, used_dict=None):
-    ''' Returns a pair of n different nodes. If a used_dict is given, the pair
-    does not repeat any element.'''
-    src, dst = random.sample(range(n), 2)
+def getPair(rng, n, used_dict=None):
+    ''' Returns a pair of n different nodes drawn with the numpy Generator
+    rng. If a used_dict is given, the pair does not repeat any element.'''
+    src, dst = _drawPair(rng, n)
     if used_dict is None:
         return src, dst
     while dst in used_dict[src]:
-        src, dst = random.sample(range(n), 2)
+        src, dst = _drawPair(rng, n)
     return src, dst
 
 
+def _drawPair(rng, n):
+    ''' Returns two different nodes of range(n). dst is drawn from n-1
+        values and shifted past src, so no candidate list is built. '''
+    src, dst = rng.integers((n, n - 1)).tolist()
+    return src, dst + 1 if dst >= src else dst
+
+
+@njit(cache=True)
+def _generate_demands(rng, n, remainingT, spInv, max_sd):
+    ''' Generates the demands of an instance until remainingT destinations
+        are used. Returns the arrays (srcs, nDsts, dsts_flat, dst_offsets,
+        slots), where the destinations of the i-th demand are
+        dsts_flat[dst_offsets[i]:dst_offsets[i+1]].
+
+        Every value is drawn from the numpy Generator rng. Destinations
+        are drawn with a partial Fisher-Yates shuffle over range(n) with
+        the source parked at the last position.
+    '''
+
+    # Every demand has at least one destination, so remainingT
+    # demands are an upper bound for the ones generated
+    nD_max = remainingT
+
+    # Loop invariant bounds of the draws
+    s_lo = max(1, max_sd // 2)
+    s_hi = max_sd
+    nDst_lo = 0.5*spInv
+    nDst_hi = 2*spInv
+    use_spread = spInv - 1 > 1e-3
+
+    srcs = rng.integers(0, n, nD_max)
+    nDsts = np.ones(nD_max, dtype=np.int64)
+    dsts_flat = np.empty(remainingT, dtype=np.int64)
+    dst_offsets = np.zeros(nD_max + 1, dtype=np.int64)
+
+    buf = np.arange(n)
+    swaps = np.empty(n, dtype=np.int64)
+    last = n - 1
+    nD = 0
+    while remainingT > 0:
+        src = srcs[nD]
+
+        nDst = 1
+        if use_spread:
+            nDst = math.ceil(rng.uniform(nDst_lo, nDst_hi))
+        nDst = min(remainingT, nDst, last)
+        remainingT = remainingT - nDst
+
+        offset = dst_offsets[nD]
+        if nDst == 1:
+            dst = rng.integers(0, last)
+            dsts_flat[offset] = dst + 1 if dst >= src else dst
+        else:
+            buf[src], buf[last] = buf[last], buf[src]
+            for i in range(nDst):
+                j = rng.integers(i, last)
+                buf[i], buf[j] = buf[j], buf[i]
+                swaps[i] = j
+                dsts_flat[offset + i] = buf[i]
+            for i in range(nDst - 1, -1, -1):
+                j = swaps[i]
+                buf[i], buf[j] = buf[j], buf[i]
+            buf[src], buf[last] = buf[last], buf[src]
+
+        nDsts[nD] = nDst
+        dst_offsets[nD + 1] = offset + nDst
+        nD += 1
+
+    # Slots do not depend on the destinations, so they are drawn in one
+    # call once the number of demands is known
+    slots = rng.integers(s_lo, s_hi+1, nD)
+
+    return (srcs[:nD], nDsts[:nD], dsts_flat, dst_offsets[:nD + 1], slots)
+
+
 def calculateGraphDensity(n, m):
     ''' Returns the density of the undirected graph '''
     return 2.*m/(n*(n-1))
@@ -68,10 +160,12 @@ def calculateMaxNumberOfDemands(n, m, S, max_sd):
 
         A tighter bound could be the min grade of the
         nodes but we want infeasible instances too.
+
+        It is (n-1) * d * S / max_sd with d the density of the graph,
+        which simplifies to 2*m*S / (n*max_sd) and is computed with
+        integers only.
     '''
-    d = calculateGraphDensity(n, m)
-    max_n_of_demands = int((n-1.) * d * S/(max_sd))
-    return max_n_of_demands
+    return (2 * m * S) // (n * max_sd)
 
 
 def readTopologyData(tops_dir, top_fname):
@@ -84,6 +178,54 @@ def readTopologyData(tops_dir, top_fname):
             return int(line[0]), int(line[1])
 
 
+def generateInstance(task):
+    ''' Generates the demands of one instance and writes its file.
+
+        task: tuple (ss, seed, density, top_dir, top_name, n, m, S,
+              max_sd, sp_str, spInv), where ss is the SeedSequence of
+              the instance and seed the one shown in its header.
+    '''
+    (ss, seed, density, top_dir, top_name, n, m, S, max_sd, sp_str,
+     spInv) = task
+    rng = np.random.default_rng(ss)
+
+    nT = calculateMaxNumberOfDemands(n, m, S, max_sd)
+    nT = int(max(1, nT * density))
+    demand_f = os.path.join(
+        top_dir, instance_fname.format(top_name, S, max_sd, nT, sp_str))
+
+    srcs, nDsts, dsts_flat, dst_offsets, slots = \
+        _generate_demands(rng, n, nT, spInv, max_sd)
+
+    nD = len(srcs)
+
+    if len(dsts_flat) == nD:
+        # Every demand has a single destination, so all the rows share
+        # the same layout and the body is formatted by one bytes % call
+        body = (_SINGLE_DST_ROW * nD) % tuple(
+            np.column_stack((srcs, dsts_flat, slots)).ravel().tolist())
+    else:
+        # Numbers are converted to text in bulk and each row only
+        # joins its preformatted fields
+        srcs_s = srcs.astype('U').tolist()
+        nDsts_s = nDsts.astype('U').tolist()
+        slots_s = slots.astype('U').tolist()
+        dsts_s = dsts_flat.astype('U').tolist()
+        offsets = dst_offsets.tolist()
+        body = ''.join([
+            f'{src}{sep}{nDst}{sep}{sep.join(dsts_s[start:end])}{sep}{s}\n'
+            for src, nDst, start, end, s in zip(srcs_s, nDsts_s, offsets,
+                                                offsets[1:], slots_s)])
+        body = body.encode()
+
+    # The whole instance is written after generating it. The body is
+    # written on its own to avoid copying it to join it with the header
+    with open(demand_f, 'wb', buffering=1 << 20) as out:
+        out.write(_PROLOG % seed)
+        out.write(f'{S}{sep}{nD}\n'.encode())
+        out.write(body)
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description=__doc__)
@@ -127,32 +269,45 @@ if __name__ == "__main__":
         if not os.path.exists(d):
             error("Directory '{}' not found.".format(d))
 
-    instance_fname = 'instance_{}_{}_{}_{}_{}.txt'
-
-    random.seed(args.seed)
-
     if not 0 < args.density < 10:
         error("Demands density must be in (0, 10)")
 
     # Available slots per fiber. Discarding non-positive values
-    avaliable_S = ([10, 15, 20, 30, 40, 60, 80, 100, 150, 200, 300, 400, 600,
-                    800, 1000] if args.slots is None else
-                   [s for s in set(args.slots) if s > 0])
+    avaliable_S = sorted({s for s in (args.slots or DEFAULT_S) if s > 0})
 
     # Default: From a lightly loaded network to a heavily loaded one.
     # Discarding values not in (0, 1]
     max_percentages_of_slots_by_demand = (np.arange(.1, .9, .1)
                                           if args.percents is None else
-                                          [p for p in set(args.percents)
-                                           if p > 0 and p <= 1])
-    
-    spreads = [sp for sp in set(args.spread) if 0 < sp <= 1]
+                                          sorted({p for p in args.percents
+                                                  if 0 < p <= 1}))
 
-    # Creation of instances directory if it does not exist
-    if not os.path.exists(instances_dir):
-        os.makedirs(instances_dir)
+    spreads = sorted({sp for sp in args.spread if 0 < sp <= 1})
 
-    for percentage in max_percentages_of_slots_by_demand:
+    # Creation of instances directory if it does not exist
+    os.makedirs(instances_dir, exist_ok=True)
+
+    # The (S, sp) invariants of each percentage are computed once for
+    # the whole sweep: max_sd_grid[i, j] is the max_sd of the i-th
+    # percentage and the j-th S.
+    Ss = np.array(avaliable_S)
+    sps = np.array(spreads)
+    pcts = np.array(max_percentages_of_slots_by_demand)
+    max_sd_grid = np.ceil(pcts[:, None] * Ss[None, :]).astype(int)
+    spInvs = 1.0 / sps
+    sweeps = [[(S, max_sd, str(sp), spInv)
+               for S, max_sd in zip(avaliable_S, max_sds)
+               for sp, spInv in zip(spreads, spInvs.tolist())]
+              for max_sds in max_sd_grid.tolist()]
+
+    # The size of every topology is read once for the whole sweep. They
+    # are sorted because the position of each task in the sweep decides
+    # the seed it is spawned, and os.listdir gives no particular order.
+    topos = {os.path.splitext(f)[0]: (f, *readTopologyData(topologies_dir, f))
+             for f in sorted(os.listdir(topologies_dir))}
+
+    tasks = []
+    for percentage, sweep in zip(max_percentages_of_slots_by_demand, sweeps):
 
         # The resulting instances are created in directories
         # acoording to their percentage and topologies
@@ -160,72 +315,28 @@ if __name__ == "__main__":
                                       "{}".format(round(percentage, 2) * 100))
 
         # Creation of instance directory if it does not exist
-        if not os.path.exists(percentage_dir):
-            os.makedirs(percentage_dir)
-
-        for top_fname in os.listdir(topologies_dir):
-            top_name = os.path.splitext(top_fname)[0]
-            n, m = readTopologyData(topologies_dir, top_fname)
+        os.makedirs(percentage_dir, exist_ok=True)
 
+        for top_name, (top_fname, n, m) in topos.items():
             # The resulting instances are created in directories
             # acoording to their topologies
             top_dir = os.path.join(percentage_dir, top_name)
 
             # Creation of instance directory if it does not exist
-            if not os.path.exists(top_dir):
-                os.makedirs(top_dir)
+            os.makedirs(top_dir, exist_ok=True)
 
             # Iterates over each available S
-            for S, sp in [(S, sp) 
-                          for S in avaliable_S 
-                          for sp in spreads]:
-                max_sd = math.ceil(percentage * S)
-
-                nT = calculateMaxNumberOfDemands(n, m, S, max_sd)
-                nT = int(max(1, nT * args.density))
-                demand_f = os.path.join(
-                    top_dir, instance_fname.format(
-                        top_name, S, max_sd, nT, str(sp)))
-
-                with open(demand_f, 'w') as out:
-                    out.write('# Created by {}\n'.format(__author__))
-                    out.write('# Version: {}\n'.format(__version__))
-                    out.write('# Seed: {}\n'.format(args.seed))
-                    out.write('# Format:\n')
-                    out.write('#   First line: S  |D|\n')
-                    out.write('#   Other lines: <src #dst dst_1 dst_2 ... dst_#dst #slots>\n')
-
-                    remainingT = nT
-                    spInv = math.pow(sp, -1)
-
-                    lines = []
-                    nD = 0
-                    while remainingT > 0:
-                        nD += 1
-                        [src] = random.sample(range(n), 1)
-
-                        nDst = 1
-                        if spInv - 1 > 0.001:
-                            nDst = math.ceil(random.uniform(0.5*spInv, 2*spInv))
-
-                        nDst: int = min(remainingT, nDst)
-                        nDst = min(n-1,nDst)
-                        remainingT = remainingT - nDst
-                        dsts = random.sample(
-                            [dst for dst in range(n) if dst != src], 
-                            nDst)
-
-                        s = random.randint(math.floor(max_sd/2), max_sd)
-                        s = max(1, s)
-                        
-                        line = '{src}{sep}{nDst}{sep}{dst}{sep}{s}'.format(
-                            S=S, sep=sep, src=src, nDst=nDst, 
-                            dst=sep.join(map(str, dsts)),
-                            s=s)
-                        lines.append(line_enter.format(line))
-                    
-                    line = '{}{}{}'.format(S, sep, nD)
-                    out.write(line_enter.format(line))
-
-                    for line in lines:
-                        out.write(line)
+            for S, max_sd, sp_str, spInv in sweep:
+                tasks.append((top_dir, top_name, n, m, S, max_sd, sp_str,
+                              spInv))
+
+    # Each instance gets its own PCG64 stream from a SeedSequence child
+    # spawned from the seed, used directly by every draw of the task, so
+    # the result of a task does not depend on the order they are run
+    seeds = np.random.SeedSequence(args.seed).spawn(len(tasks))
+    tasks = [(ss, args.seed, args.density) + task
+             for ss, task in zip(seeds, tasks)]
+
+    with Pool(os.cpu_count()) as pool:
+        for _ in pool.imap_unordered(generateInstance, tasks, chunksize=8):
+            pass